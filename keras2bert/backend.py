@@ -27,6 +27,20 @@ def gelu_erf(x):
     return 0.5 * x * (1.0 + tf.math.erf(x / np.sqrt(2)))
 
 
+def bias_gelu_tanh(x, bias):
+    """bias-add与gelu近似算法融合, 只需遍历一次输入.
+    """
+    x = x + bias
+    return 0.5 * x * (1.0 + tf.tanh(np.sqrt(2.0 / np.pi) * (x + 0.044715 * x * x * x)))
+
+
+def bias_gelu_erf(x, bias):
+    """bias-add与gelu精确算法融合, 只需遍历一次输入.
+    """
+    x = x + bias
+    return 0.5 * x * (1.0 + tf.math.erf(x / np.sqrt(2)))
+
+
 def set_gelu(name):
     """选择gelu精确算法还是近似算法
     """
@@ -38,6 +52,21 @@ def set_gelu(name):
         keras.utils.get_custom_objects()['gelu'] = gelu_tanh
 
 
+def set_mixed_precision(name=None):
+    """设置混合精度策略, 可选'fp16'或'bf16'
+    返回之前的全局策略, 用于构建完成后恢复; name为None时不做修改, 返回None.
+    """
+    assert name in [None, 'fp16', 'bf16'], "set_mixed_precision name must be None, 'fp16' or 'bf16'"
+    if name is None:
+        return None
+    previous_policy = keras.mixed_precision.global_policy()
+    if name == 'fp16':
+        keras.mixed_precision.set_global_policy('mixed_float16')
+    else:
+        keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    return previous_policy
+
+
 def softmax(x, axis=-1):
     """自定义softmax激活函数.
     """
@@ -54,6 +83,9 @@ def mask_sequences(x, mask, axis=1, value=None):
     mask = K.cast(mask, K.dtype(x))
     if value == '-inf':
         value = -K.infinity()
+        if K.dtype(x) == 'float16':
+            # float16最大值约为65504, 避免mask时溢出为inf
+            value = max(value, -1e4)
     if axis < 0:
         axis = K.ndim(x) + axis
     for _ in range(axis-1):
@@ -158,3 +190,8 @@ custom_objects = {
 }
 keras.utils.get_custom_objects().update(custom_objects)
 
+fused_bias_activations = {
+    gelu_tanh: bias_gelu_tanh,
+    gelu_erf: bias_gelu_erf,
+}
+
@@ -1,8 +1,19 @@
-from keras2bert.backend import keras, K, mask_sequences
+from keras2bert.backend import keras, K, mask_sequences, fused_bias_activations
 from keras.layers import *
 import tensorflow as tf
 
 
+_JIT_FUNCTIONS = {}
+
+
+def jit_compiled(func):
+    """返回func经XLA编译后的版本, 在首次使用时才创建, 导入模块时不依赖TF2.
+    """
+    if func not in _JIT_FUNCTIONS:
+        _JIT_FUNCTIONS[func] = tf.function(func, jit_compile=True)
+    return _JIT_FUNCTIONS[func]
+
+
 class Layer(keras.layers.Layer):
     """重定义层，支持mask
     """
@@ -134,7 +145,7 @@ class PositionEmbedding(keras.layers.Layer):
     def get_config(self):
         config = {
             "input_dim": self.input_dim,
-            "out_dim": self.output_dim,
+            "output_dim": self.output_dim,
             "mode": self.mode,
             "embedding_initializer": keras.initializers.serialize(self.embedding_initializer),
             "embedding_regularizer": keras.initializers.serialize(self.embeddings_regularizer),
@@ -265,6 +276,8 @@ class MultiHeadSelfAttention(keras.layers.Layer):
 
     def build(self, input_shape):
         super(MultiHeadSelfAttention, self).build(input_shape)
+        # 预先算好缩放系数, 用乘法代替除法
+        self.score_scale = 1.0 / self.query_size ** 0.5
 
         self.q_dense = Dense(
             self.head_num * self.query_size,
@@ -296,15 +309,21 @@ class MultiHeadSelfAttention(keras.layers.Layer):
         kw = K.reshape(kw, (-1, K.shape(kw)[1], self.head_num, self.query_size))
         vw = K.reshape(vw, (-1, K.shape(vw)[1], self.head_num, self.key_size))
 
-        a = tf.einsum('bmhd, bnhd->bhmn', qw, kw)
-        a = a / self.query_size ** 0.5
+        # 转置为(batch, head, seq, dim), 使attention可以直接走batch matmul
+        qw = tf.transpose(qw, [0, 2, 1, 3])
+        kw = tf.transpose(kw, [0, 2, 1, 3])
+        vw = tf.transpose(vw, [0, 2, 1, 3])
+
+        a = tf.matmul(qw, kw, transpose_b=True)
+        a = a * self.score_scale
         a = mask_sequences(a, mask[1], axis=-1, value='-inf')
 
         # 将attention score归一化成概率分布
-        a = K.softmax(a, axis=-1)
+        a = tf.nn.softmax(a, axis=-1)
         # 这里的dropout参考自google transformer论文
         a = keras.layers.Dropout(self.attention_dropout_rate)(a)
-        o = tf.einsum('bhmn, bnhd->bmhd', a, vw)
+        o = tf.matmul(a, vw)
+        o = tf.transpose(o, [0, 2, 1, 3])
 
         o = K.reshape(o, (-1, K.shape(o)[1], self.head_num * self.key_size))
         o = self.o_dense(o)
@@ -323,7 +342,10 @@ class MultiHeadSelfAttention(keras.layers.Layer):
             "head_num": self.head_num,
             "query_size": self.query_size,
             "key_size": self.key_size,
-            "feature_dim": self.feature_dim,
+            "output_dim": self.feature_dim,
+            "use_bias": self.use_bias,
+            "attention_dropout_rate": self.attention_dropout_rate,
+            "kernel_initializer": keras.initializers.serialize(keras.initializers.get(self.kernel_initializer)),
         }
         base_config = super(MultiHeadSelfAttention, self).get_config()
         config.update(base_config)
@@ -344,6 +366,7 @@ class FeedForward(keras.layers.Layer):
                  constraint=None,
                  use_bias=True,
                  dropout_rate=0.0,
+                 fuse_bias_activation=False,
                  **kwargs):
         super(FeedForward, self).__init__(**kwargs)
         self.units = units
@@ -355,6 +378,7 @@ class FeedForward(keras.layers.Layer):
         self.constraint = keras.constraints.get(constraint)
         self.use_bias = use_bias
         self.dropout_rate = dropout_rate
+        self.fuse_bias_activation = fuse_bias_activation
 
     def build(self, input_shape):
         super(FeedForward, self).build(input_shape)
@@ -367,6 +391,12 @@ class FeedForward(keras.layers.Layer):
                 kernel_initializer=self.kernel_initializer,
             )
             setattr(self, 'h_dense_%i' % i, self.h_dense)
+        # 单个gelu激活时, 可选将bias-add与激活融合为一个XLA kernel
+        self.fused_activation = None
+        if self.fuse_bias_activation and len(self.activation) == 1 and self.use_bias:
+            self.fused_activation = fused_bias_activations.get(self.activation[0])
+            if self.fused_activation is not None:
+                self.h_dense_0.build(input_shape)
         self.o_dense = keras.layers.Dense(
             units=output_dim,
             use_bias=self.use_bias,
@@ -374,7 +404,10 @@ class FeedForward(keras.layers.Layer):
         )
 
     def call(self, inputs, **kwargs):
-        h = getattr(self, 'h_dense_0')(inputs)
+        if self.fused_activation is not None:
+            h = jit_compiled(self.fused_activation)(K.dot(inputs, self.h_dense_0.kernel), self.h_dense_0.bias)
+        else:
+            h = getattr(self, 'h_dense_0')(inputs)
         for i in range(1, len(self.activation)):
             h = h * getattr(self, 'h_dense_%i' %i)(inputs)
             if 0 < self.dropout_rate < 1.0:
@@ -391,12 +424,13 @@ class FeedForward(keras.layers.Layer):
     def get_config(self):
         config = {
             "units": self.units,
-            "activation": keras.activations.serialize(self.activation),
+            "activation": [keras.activations.serialize(act) for act in self.activation],
             "kernel_initializer": keras.initializers.serialize(self.kernel_initializer),
             "regularizer": keras.regularizers.serialize(self.regularizer),
             "constraint": keras.constraints.serialize(self.constraint),
             "use_bias": self.use_bias,
             "dropout_rate": self.dropout_rate,
+            "fuse_bias_activation": self.fuse_bias_activation,
         }
         base_config = super(FeedForward, self).get_config()
         config.update(base_config)
@@ -463,6 +497,55 @@ class LayerNormalization(keras.layers.Layer):
         return config
 
 
+def _add_layer_norm(x, y, gamma, beta, episilon):
+    """残差相加与层归一化在同一个XLA kernel中完成, 不单独输出mean和variance
+    """
+    x = x + y
+    mean = tf.reduce_mean(x, axis=-1, keepdims=True)
+    x = x - mean
+    variance = tf.reduce_mean(tf.square(x), axis=-1, keepdims=True)
+    return x * tf.math.rsqrt(variance + episilon) * gamma + beta
+
+
+class AddLayerNormalization(LayerNormalization):
+    """残差连接与层归一化融合, 输入为[x, residual], jit_compile为True时用XLA融合计算
+    """
+    def __init__(self, jit_compile=False, **kwargs):
+        super(AddLayerNormalization, self).__init__(**kwargs)
+        self.jit_compile = jit_compile
+
+    def build(self, input_shape):
+        super(AddLayerNormalization, self).build(input_shape[0])
+
+    def call(self, inputs, **kwargs):
+        x, y = inputs
+        if self.jit_compile and self.scale and self.center:
+            return jit_compiled(_add_layer_norm)(
+                x,
+                y,
+                K.cast(self.gamma, K.dtype(x)),
+                K.cast(self.beta, K.dtype(x)),
+                self.episilon,
+            )
+        return super(AddLayerNormalization, self).call(x + y)
+
+    def get_config(self):
+        config = {
+            "jit_compile": self.jit_compile,
+        }
+        base_config = super(AddLayerNormalization, self).get_config()
+        config.update(base_config)
+        return config
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0]
+
+    def compute_mask(self, inputs, mask=None):
+        if isinstance(mask, list):
+            return mask[0]
+        return mask
+
+
 class EmbeddingSimilarity(keras.layers.Layer):
     """用于输出特征与输入embedding矩阵的相似度计算
     """
@@ -1,12 +1,78 @@
+from keras2bert.backend import set_mixed_precision
 from keras2bert.layers import *
+import numpy as np
+import warnings
 import json
+import os
+
+
+class MultiHeadSelfAttention(MultiHeadSelfAttention):
+    """投影权重按(head_num, head_size, hidden_dim)存放, 使收缩维在两个操作数中都位于最后
+    Q/K/V共用一个(3 * head_num, head_size, hidden_dim)的权重, 一次投影后再切分,
+    因此要求query_size == key_size, 且只使用inputs[0]作为输入(自注意力).
+    """
+    def build(self, input_shape):
+        Layer.build(self, input_shape)
+        self.score_scale = 1.0 / self.query_size ** 0.5
+        assert self.query_size == self.key_size, 'Fused QKV projection requires query_size == key_size.'
+        hidden_dim = int(input_shape[0][-1])
+        self.qkv_kernel, self.qkv_bias = self._add_projection_weights(
+            'qkv', (3 * self.head_num, self.query_size, hidden_dim), (3 * self.head_num, self.query_size))
+        self.o_kernel, self.o_bias = self._add_projection_weights(
+            'o', (self.feature_dim, self.head_num, self.key_size), (self.feature_dim,))
+        # 在build中创建, 使其与本层处于同一混合精度策略下, 不受之后全局策略恢复的影响
+        self.attention_dropout = keras.layers.Dropout(self.attention_dropout_rate)
+
+    def _add_projection_weights(self, name, kernel_shape, bias_shape):
+        kernel = self.add_weight(
+            name='%s_kernel' % name,
+            shape=kernel_shape,
+            initializer=self.kernel_initializer,
+        )
+        bias = None
+        if self.use_bias:
+            bias = self.add_weight(
+                name='%s_bias' % name,
+                shape=bias_shape,
+                initializer='zeros',
+            )
+        return kernel, bias
+
+    def _project(self, inputs, kernel, bias):
+        """投影后直接输出(batch, head, seq, dim), 省去额外的转置
+        """
+        o = tf.einsum('bnc,hdc->bhnd', inputs, kernel)
+        if self.use_bias:
+            o = o + bias[:, None]
+        return o
+
+    def call(self, inputs, mask=None):
+        qkv = self._project(inputs[0], self.qkv_kernel, self.qkv_bias)
+        qw, kw, vw = tf.split(qkv, 3, axis=1)
+
+        a = tf.matmul(qw, kw, transpose_b=True)
+        a = a * self.score_scale
+        a = mask_sequences(a, mask[1], axis=-1, value='-inf')
+
+        # 将attention score归一化成概率分布
+        a = tf.nn.softmax(a, axis=-1)
+        # 这里的dropout参考自google transformer论文
+        a = self.attention_dropout(a)
+        o = tf.matmul(a, vw)
+
+        o = tf.einsum('bhmd,chd->bmc', o, self.o_kernel)
+        if self.use_bias:
+            o = o + self.o_bias
+
+        return o
 
 
 def _wrap_layer(name,
                 input_layer,
                 build_func,
                 dropout_rate=0.0,
-                trainable=True):
+                trainable=True,
+                jit_compile=False):
     """Wrap layers with dropout, residual, normalization.
     """
     build_output = build_func(input_layer)
@@ -19,11 +85,11 @@ def _wrap_layer(name,
         dropout_layer = build_output
     if isinstance(input_layer, list):
         input_layer = input_layer[0]
-    add_layer = keras.layers.Add(name='%s-Add' % name)([input_layer, dropout_layer])
-    normal_layer = LayerNormalization(
+    normal_layer = AddLayerNormalization(
+        jit_compile=jit_compile,
         trainable=trainable,
-        name='%s-Norm' % name,
-    )(add_layer)
+        name='%s-AddNorm' % name,
+    )([input_layer, dropout_layer])
     return normal_layer
 
 
@@ -58,7 +124,11 @@ def get_encoder_component(name,
                           kernel_initializer='uniform',
                           attention_dropout_rate=0.0,
                           hidden_dropout_rate=0.0,
-                          trainable=True):
+                          trainable=True,
+                          jit_compile=False):
+    assert hidden_dim % head_num == 0, \
+        'hidden_dim (%d) must be divisible by head_num (%d).' % (hidden_dim, head_num)
+    head_size = int(hidden_dim // head_num)
     attention_name = "%s-MultiHeadSelfAttention" % name
     feed_forward_name = '%s-FeedForward' % name
     attention_layer = _wrap_layer(
@@ -66,8 +136,8 @@ def get_encoder_component(name,
         input_layer=[input_layer, input_layer, input_layer],
         build_func=MultiHeadSelfAttention(
             head_num=head_num,
-            query_size=hidden_dim // head_num,
-            key_size=hidden_dim // head_num,
+            query_size=head_size,
+            key_size=head_size,
             output_dim=hidden_dim,
             attention_dropout_rate=attention_dropout_rate,
             kernel_initializer=kernel_initializer,
@@ -76,6 +146,7 @@ def get_encoder_component(name,
         ),
         dropout_rate=hidden_dropout_rate,
         trainable=trainable,
+        jit_compile=jit_compile,
     )
     feed_forward_layer = _wrap_layer(
         name=feed_forward_name,
@@ -84,11 +155,13 @@ def get_encoder_component(name,
             units=feed_forward_dim,
             activation=feed_forward_activation,
             kernel_initializer=kernel_initializer,
+            fuse_bias_activation=jit_compile,
             trainable=trainable,
             name=feed_forward_name,
         ),
         dropout_rate=hidden_dropout_rate,
-        trainable=trainable
+        trainable=trainable,
+        jit_compile=jit_compile,
     )
     return feed_forward_layer
 
@@ -102,7 +175,8 @@ def get_encoders(encoder_num,
                  kernel_initializer='uniform',
                  attention_dropout_rate=0.0,
                  hidden_dropout_rate=0.0,
-                 trainable=True):
+                 trainable=True,
+                 jit_compile=False):
     last_layer = input_layer
     for i in range(encoder_num):
         last_layer = get_encoder_component(
@@ -115,16 +189,19 @@ def get_encoders(encoder_num,
             kernel_initializer=kernel_initializer,
             attention_dropout_rate=attention_dropout_rate,
             hidden_dropout_rate=hidden_dropout_rate,
-            trainable=trainable
+            trainable=trainable,
+            jit_compile=jit_compile,
         )
     return last_layer
 
 
-def get_inputs(seq_len=None):
+def get_inputs(seq_len=None, single_segment=False):
     input_token_ids = keras.layers.Input(
         shape=(seq_len,),
         name='Input-%s' % 'Token'
     )
+    if single_segment:
+        return input_token_ids, None
     input_segment_ids = keras.layers.Input(
         shape=(seq_len,),
         name='Input-%s' % 'Segment'
@@ -139,24 +216,30 @@ def get_embeddings(inputs,
                    hidden_dim,
                    embedding_initializer,
                    max_pos_num,
-                   embedding_dropout_rate):
+                   embedding_dropout_rate,
+                   single_segment=False):
     input_token_ids, input_segment_ids = inputs
-    embedding_token, token_embeddings = TokenEmbedding(
+    # electra没有MLM输出, 不需要返回词向量矩阵
+    embedding_token = Embedding(
         input_dim=vocab_size,
         output_dim=embedding_dim,
         embeddings_initializer=embedding_initializer,
         mask_zero=True,
         name='Embedding-Token'
     )(input_token_ids)
-    embedding_segment = Embedding(
-        input_dim=segment_type_size,
-        output_dim=embedding_dim,
-        embeddings_initializer=embedding_initializer,
-        name='Embedding-Segment'
-    )(input_segment_ids)
-    embeddings = keras.layers.Add(
-        name='Embedding-Add-Token-Segment'
-    )([embedding_token, embedding_segment])
+    if single_segment:
+        # 只有一个segment时, segment向量是常量, 加载权重时并入位置向量
+        embeddings = embedding_token
+    else:
+        embedding_segment = Embedding(
+            input_dim=segment_type_size,
+            output_dim=embedding_dim,
+            embeddings_initializer=embedding_initializer,
+            name='Embedding-Segment'
+        )(input_segment_ids)
+        embeddings = keras.layers.Add(
+            name='Embedding-Add-Token-Segment'
+        )([embedding_token, embedding_segment])
     embeddings = _wrap_embedding(
         name='Embedding',
         input_layer=embeddings,
@@ -175,7 +258,7 @@ def get_embeddings(inputs,
             kernel_initializer=embedding_initializer,
             name='Embedding-Map'
         )(embeddings)
-    return embeddings, token_embeddings
+    return embeddings, None
 
 
 def get_model(vocab_size,
@@ -192,9 +275,10 @@ def get_model(vocab_size,
               hidden_dropout_rate,
               bert_initializer,
               with_discriminator=False,
+              single_segment=False,
               **kwargs):
-    input_token_ids, input_segment_ids = get_inputs(seq_len)
-    embeddings, token_embeddings = get_embeddings(
+    input_token_ids, input_segment_ids = get_inputs(seq_len, single_segment)
+    embeddings, _ = get_embeddings(
         inputs=[input_token_ids, input_segment_ids],
         vocab_size=vocab_size,
         segment_type_size=segment_type_size,
@@ -203,6 +287,7 @@ def get_model(vocab_size,
         hidden_dim=hidden_dim,
         embedding_initializer=bert_initializer,
         embedding_dropout_rate=hidden_dropout_rate,
+        single_segment=single_segment,
     )
     output = get_encoders(
         encoder_num=transformer_num,
@@ -228,11 +313,14 @@ def get_model(vocab_size,
             units=1,
             activation='sigmoid',
             kernel_initializer=bert_initializer,
+            dtype='float32',
             name='Discriminator-Prediction')\
         (disc_dense)
 
     if with_discriminator:
         output = disc_output
+    if single_segment:
+        return [input_token_ids], output
     return [input_token_ids, input_segment_ids], output
 
 
@@ -241,8 +329,20 @@ def build_electra_model(config_file,
                         trainable=True,
                         seq_len=int(1e9),
                         with_discriminator=False,
+                        mixed_precision=None,
+                        jit_compile=False,
+                        single_segment=False,
+                        saved_model_dir=None,
                         **kwargs):
     """Build the model from config file.
+    mixed_precision: None, 'fp16' or 'bf16', 开启混合精度时判别器输出层保持float32.
+    jit_compile: 用XLA编译该模型的call, 每层的Add+LayerNorm、GELU、Dropout等逐元素运算可融合为单个kernel.
+    single_segment: 只输入token ids(segment全为0), 省去segment embedding及其Add.
+    seq_len: 默认int(1e9)表示变长输入; 指定具体长度(如128或512)时构建静态shape的模型,
+        长度不超过max_position_embeddings, 配合jit_compile=True每个长度只需编译一次.
+    saved_model_dir: 若目录中已有SavedModel则直接加载, 跳过构图和读取checkpoint,
+        保存时的config内容、checkpoint中各变量的shape以及其余构建参数(含trainable和kwargs)须与本次一致;
+        否则构建并加载权重后保存到该目录, 供下次使用.
     # Reference:
         [ELECTRA: Pre-training Text Encoders as Discriminators Rather Than Generators]
         (https://openreview.net/pdf?id=r1xMH1BtvB)
@@ -251,42 +351,166 @@ def build_electra_model(config_file,
     with open(config_file, 'r') as reader:
         config = json.loads(reader.read())
 
+    # 影响模型结构和权重的构建参数, 与SavedModel一起保存, 加载缓存时校验
+    build_args = {
+        'config': config,
+        'checkpoint': tf.train.list_variables(checkpoint_file) if checkpoint_file else None,
+        'trainable': trainable,
+        'with_discriminator': with_discriminator,
+        'single_segment': single_segment,
+        'seq_len': seq_len,
+        'mixed_precision': mixed_precision,
+        'jit_compile': jit_compile,
+        'kwargs': kwargs,
+    }
+    # 经过一次json序列化, 使其与从文件读回的内容可以直接比较
+    build_args = json.loads(json.dumps(build_args, default=str))
+    if saved_model_dir and os.path.isfile(os.path.join(saved_model_dir, 'saved_model.pb')):
+        # 各层在build中创建的子层跟随全局策略, 加载时需与构建时一致
+        previous_policy = set_mixed_precision(mixed_precision)
+        try:
+            model = load_saved_model(saved_model_dir, build_args)
+        finally:
+            if previous_policy is not None:
+                keras.mixed_precision.set_global_policy(previous_policy)
+        if jit_compile:
+            model.call = tf.function(model.call, jit_compile=True)
+        return model
+
     if seq_len is not None:
         config['max_position_embeddings'] = min(seq_len, config['max_position_embeddings'])
+    # 静态长度不能超过位置向量表的长度, 因此使用截断后的max_position_embeddings
+    static_seq_len = seq_len is not None and seq_len != int(1e9)
 
-    config['bert_initializer'] = keras.initializers.TruncatedNormal(0, 0.02)
-    inputs, outputs = get_model(
-        vocab_size=config['vocab_size'],
-        segment_type_size=config['type_vocab_size'],
-        max_pos_num=config['max_position_embeddings'],
-        seq_len=None,
-        embedding_dim=config.get('embedding_size', config.get('hidden_size')),
-        hidden_dim=config['hidden_size'],
-        transformer_num=config['num_hidden_layers'],
-        head_num=config['num_attention_heads'],
-        feed_forward_dim=config['intermediate_size'],
-        feed_forward_activation=config['hidden_act'],
-        attention_dropout_rate=config['attention_probs_dropout_prob'],
-        hidden_dropout_rate=config['hidden_dropout_prob'],
-        bert_initializer=config['bert_initializer'],
-        with_discriminator=with_discriminator,
-        trainable=trainable,
-        **kwargs,
-    )
-    model = keras.models.Model(inputs=inputs, outputs=outputs)
-    load_model_weights_from_checkpoint(
-        model,
-        config,
-        checkpoint_file,
-        with_discriminator=with_discriminator
-    )
+    if mixed_precision is not None:
+        # tensor core的fp16/bf16 GEMM要求矩阵维度为8的倍数
+        for key in ['embedding_size', 'hidden_size', 'intermediate_size']:
+            if key in config and config[key] % 8 != 0:
+                warnings.warn('%s=%d is not a multiple of 8, tensor cores may not be used.' % (key, config[key]))
+
+    # 权重随后会从checkpoint覆盖, 无需再做截断正态采样
+    if checkpoint_file:
+        config['bert_initializer'] = keras.initializers.Zeros()
+    else:
+        config['bert_initializer'] = keras.initializers.TruncatedNormal(0, 0.02)
+    previous_policy = set_mixed_precision(mixed_precision)
+    try:
+        inputs, outputs = get_model(
+            vocab_size=config['vocab_size'],
+            segment_type_size=config['type_vocab_size'],
+            max_pos_num=config['max_position_embeddings'],
+            seq_len=config['max_position_embeddings'] if static_seq_len else None,
+            embedding_dim=config.get('embedding_size', config.get('hidden_size')),
+            hidden_dim=config['hidden_size'],
+            transformer_num=config['num_hidden_layers'],
+            head_num=config['num_attention_heads'],
+            feed_forward_dim=config['intermediate_size'],
+            feed_forward_activation=config['hidden_act'],
+            attention_dropout_rate=config['attention_probs_dropout_prob'],
+            hidden_dropout_rate=config['hidden_dropout_prob'],
+            bert_initializer=config['bert_initializer'],
+            with_discriminator=with_discriminator,
+            single_segment=single_segment,
+            trainable=trainable,
+            jit_compile=jit_compile,
+            **kwargs,
+        )
+        # Model也需在混合精度策略下创建, compile时才会自动使用LossScaleOptimizer
+        model = keras.models.Model(inputs=inputs, outputs=outputs)
+    finally:
+        # 混合精度策略是全局的, 构建完成后恢复, 避免影响之后构建的模型
+        if previous_policy is not None:
+            keras.mixed_precision.set_global_policy(previous_policy)
+    if checkpoint_file:
+        load_model_weights_from_checkpoint(
+            model,
+            config,
+            checkpoint_file,
+            with_discriminator=with_discriminator
+        )
+    if saved_model_dir:
+        model.save(saved_model_dir, save_format='tf')
+        with open(os.path.join(saved_model_dir, _BUILD_ARGS_FILE), 'w') as writer:
+            writer.write(json.dumps(build_args))
+    if jit_compile:
+        # 只对该模型开启XLA, 不修改进程级的jit设置
+        model.call = tf.function(model.call, jit_compile=True)
     return model
 
 
+_BUILD_ARGS_FILE = 'keras2bert_build_args.json'
+
+
+def load_saved_model(saved_model_dir, build_args):
+    """加载build_electra_model保存的SavedModel, 构建参数不一致时报错.
+    """
+    build_args_file = os.path.join(saved_model_dir, _BUILD_ARGS_FILE)
+    saved_args = None
+    if os.path.isfile(build_args_file):
+        with open(build_args_file, 'r') as reader:
+            saved_args = json.loads(reader.read())
+    if saved_args != build_args:
+        raise ValueError(
+            'The SavedModel in %s was built with %s, which does not match the requested %s. '
+            'Use another saved_model_dir or remove the existing one.' % (saved_model_dir, saved_args, build_args)
+        )
+    return keras.models.load_model(
+        saved_model_dir,
+        custom_objects={
+            'PositionEmbedding': PositionEmbedding,
+            'LayerNormalization': LayerNormalization,
+            'AddLayerNormalization': AddLayerNormalization,
+            'MultiHeadSelfAttention': MultiHeadSelfAttention,
+            'FeedForward': FeedForward,
+        },
+        compile=False,
+    )
+
+
+_ENCODER_WEIGHT_NAMES = (
+    'bert/encoder/layer_%d/attention/self/query/kernel',
+    'bert/encoder/layer_%d/attention/self/query/bias',
+    'bert/encoder/layer_%d/attention/self/key/kernel',
+    'bert/encoder/layer_%d/attention/self/key/bias',
+    'bert/encoder/layer_%d/attention/self/value/kernel',
+    'bert/encoder/layer_%d/attention/self/value/bias',
+    'bert/encoder/layer_%d/attention/output/dense/kernel',
+    'bert/encoder/layer_%d/attention/output/dense/bias',
+    'bert/encoder/layer_%d/attention/output/LayerNorm/gamma',
+    'bert/encoder/layer_%d/attention/output/LayerNorm/beta',
+    'bert/encoder/layer_%d/intermediate/dense/kernel',
+    'bert/encoder/layer_%d/intermediate/dense/bias',
+    'bert/encoder/layer_%d/output/dense/kernel',
+    'bert/encoder/layer_%d/output/dense/bias',
+    'bert/encoder/layer_%d/output/LayerNorm/gamma',
+    'bert/encoder/layer_%d/output/LayerNorm/beta',
+)
+
+
+def _to_head_kernel(kernel, head_num):
+    """(hidden_dim, head_num * head_size) -> (head_num, head_size, hidden_dim)
+    """
+    kernel = np.reshape(kernel, (kernel.shape[0], head_num, -1))
+    return np.transpose(kernel, (1, 2, 0))
+
+
+def _to_head_output_kernel(kernel, head_num):
+    """(head_num * head_size, hidden_dim) -> (hidden_dim, head_num, head_size)
+    """
+    return np.reshape(np.transpose(kernel), (kernel.shape[1], head_num, -1))
+
+
+def _to_head_bias(bias, head_num):
+    """(head_num * head_size,) -> (head_num, head_size)
+    """
+    return np.reshape(bias, (head_num, -1))
+
+
 def checkpoint_loader(checkpoint_file):
-    def _loader(name):
-        return tf.train.load_variable(checkpoint_file, name)
-    return _loader
+    """所有变量共用同一个CheckpointReader, 避免每次读取都重新打开checkpoint
+    """
+    reader = tf.train.load_checkpoint(checkpoint_file)
+    return reader.get_tensor
 
 
 def load_model_weights_from_checkpoint(model,
@@ -296,60 +520,68 @@ def load_model_weights_from_checkpoint(model,
     """Load trained official model from checkpoint.
     """
     loader = checkpoint_loader(checkpoint_file)
+    head_num = config['num_attention_heads']
+    layers_by_name = {layer.name: layer for layer in model.layers}
+    # 先收集(variable, value)对, 最后一次性赋值
+    weight_value_pairs = []
+
+    def _assign(name, values):
+        weights = layers_by_name[name].weights
+        assert len(weights) == len(values), \
+            'Layer %s expects %d weights, but %d were provided.' % (name, len(weights), len(values))
+        weight_value_pairs.extend(zip(weights, values))
 
-    model.get_layer(name='Embedding-Token').set_weights([
+    _assign('Embedding-Token', [
         loader('bert/embeddings/word_embeddings'),
     ])
-    model.get_layer(name='Embedding-Segment').set_weights([
-        loader('bert/embeddings/token_type_embeddings'),
-    ])
-    model.get_layer(name='Embedding-Position').set_weights([
-        loader('bert/embeddings/position_embeddings')[:config['max_position_embeddings'], :],
+    # 拷贝截取部分, 释放完整的位置向量表
+    position_embeddings = loader('bert/embeddings/position_embeddings')[:config['max_position_embeddings']].copy()
+    if 'Embedding-Segment' in layers_by_name:
+        _assign('Embedding-Segment', [
+            loader('bert/embeddings/token_type_embeddings'),
+        ])
+    else:
+        # single_segment模式下segment全为0, 将第0个segment向量并入位置向量
+        position_embeddings = position_embeddings + loader('bert/embeddings/token_type_embeddings')[0]
+    _assign('Embedding-Position', [
+        position_embeddings,
     ])
-    model.get_layer(name='Embedding-Norm').set_weights([
+    _assign('Embedding-Norm', [
         loader('bert/embeddings/LayerNorm/gamma'),
         loader('bert/embeddings/LayerNorm/beta'),
     ])
-    model.get_layer(name='Embedding-Map').set_weights([
-        loader('electra/embeddings_project/kernel'),
-        loader('electra/embeddings_project/bias'),
-    ])
+    # embedding_size == hidden_size时没有Embedding-Map层
+    if 'Embedding-Map' in layers_by_name:
+        _assign('Embedding-Map', [
+            loader('electra/embeddings_project/kernel'),
+            loader('electra/embeddings_project/bias'),
+        ])
     for i in range(config['num_hidden_layers']):
-        try:
-            model.get_layer(name='Encoder-%d-MultiHeadSelfAttention' % i)
-        except ValueError as e:
+        name = 'Encoder-%d' % i
+        if '%s-MultiHeadSelfAttention' % name not in layers_by_name:
             continue
-        model.get_layer(name='Encoder-%d-MultiHeadSelfAttention' % i).set_weights([
-            loader('bert/encoder/layer_%d/attention/self/query/kernel' % i),
-            loader('bert/encoder/layer_%d/attention/self/query/bias' % i),
-            loader('bert/encoder/layer_%d/attention/self/key/kernel' % i),
-            loader('bert/encoder/layer_%d/attention/self/key/bias' % i),
-            loader('bert/encoder/layer_%d/attention/self/value/kernel' % i),
-            loader('bert/encoder/layer_%d/attention/self/value/bias' % i),
-            loader('bert/encoder/layer_%d/attention/output/dense/kernel' % i),
-            loader('bert/encoder/layer_%d/attention/output/dense/bias' % i),
-        ])
-        model.get_layer(name='Encoder-%d-MultiHeadSelfAttention-Norm' % i).set_weights([
-            loader('bert/encoder/layer_%d/attention/output/LayerNorm/gamma' % i),
-            loader('bert/encoder/layer_%d/attention/output/LayerNorm/beta' % i),
-        ])
-        model.get_layer(name='Encoder-%d-FeedForward' % i).set_weights([
-            loader('bert/encoder/layer_%d/intermediate/dense/kernel' % i),
-            loader('bert/encoder/layer_%d/intermediate/dense/bias' % i),
-            loader('bert/encoder/layer_%d/output/dense/kernel' % i),
-            loader('bert/encoder/layer_%d/output/dense/bias' % i),
-        ])
-        model.get_layer(name='Encoder-%d-FeedForward-Norm' % i).set_weights([
-            loader('bert/encoder/layer_%d/output/LayerNorm/gamma' % i),
-            loader('bert/encoder/layer_%d/output/LayerNorm/beta' % i),
+        (q_kernel, q_bias, k_kernel, k_bias, v_kernel, v_bias, o_kernel, o_bias,
+         attention_gamma, attention_beta,
+         h_kernel, h_bias, f_kernel, f_bias,
+         feed_forward_gamma, feed_forward_beta) = [loader(t % i) for t in _ENCODER_WEIGHT_NAMES]
+        _assign('%s-MultiHeadSelfAttention' % name, [
+            np.concatenate([_to_head_kernel(w, head_num) for w in (q_kernel, k_kernel, v_kernel)], axis=0),
+            np.concatenate([_to_head_bias(b, head_num) for b in (q_bias, k_bias, v_bias)], axis=0),
+            _to_head_output_kernel(o_kernel, head_num),
+            o_bias,
         ])
+        _assign('%s-MultiHeadSelfAttention-AddNorm' % name, [attention_gamma, attention_beta])
+        _assign('%s-FeedForward' % name, [h_kernel, h_bias, f_kernel, f_bias])
+        _assign('%s-FeedForward-AddNorm' % name, [feed_forward_gamma, feed_forward_beta])
 
     if with_discriminator:
-        model.get_layer(name='Discriminator-Dense').set_weights([
+        _assign('Discriminator-Dense', [
             loader('discriminator_predictions/dense/kernel'),
             loader('discriminator_predictions/dense/bias'),
         ])
-        model.get_layer(name='Discriminator-Prediction').set_weights([
+        _assign('Discriminator-Prediction', [
             loader('discriminator_predictions/dense_1/kernel'),
             loader('discriminator_predictions/dense_1/bias'),
         ])
+
+    K.batch_set_value(weight_value_pairs)